@@ -12,19 +12,149 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
 import fnmatch
+import hashlib
 import json
 import logging
 import os
+import pickle
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 import lxml.etree as ET
 import xmlschema
+from cachetools import LRUCache, TTLCache
 from pygls.uris import to_fs_path
 
+# Compiled schemas are pickled here, so that a restarted server need not
+# rebuild the XSD component graph, which can take seconds for large schemas.
+_SCHEMA_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "xml-lsp"
+)
 
-def _find_schemapath_by_rootelement(xml_doc, searchpaths):
-    """Finds schema file path based on root element name."""
+
+# lxml parsers can be reused for any number of parses, but not from two
+# threads at once, so each thread keeps its own.
+_parsers = threading.local()
+
+
+def _peek_parser():
+    """Returns this thread's recovering pull parser for root start tags."""
+    parser = getattr(_parsers, "peek", None)
+    if parser is None:
+        # The content is always UTF-8, whatever its declaration says.
+        parser = _parsers.peek = ET.XMLPullParser(
+            events=("start",), encoding="utf-8", recover=True
+        )
+    return parser
+
+
+def _peek_root_element(content, chunk_size=4096):
+    """
+    Returns the root element of a UTF-8 encoded document, or None.
+
+    The document is fed to a recovering pull parser a chunk at a time, only
+    until the root start tag has been read, so the cost does not grow with the
+    size of the document. The element has its tag, attributes and namespace
+    map; any children it has are only those in the chunk that was read.
+    """
+    parser = _peek_parser()
+    try:
+        for start in range(0, len(content), chunk_size):
+            parser.feed(bytes(content[start : start + chunk_size]))
+            for _, root in parser.read_events():
+                return root
+        # A start tag cut off by the end of the document is still recovered.
+        parser.close()
+        for _, root in parser.read_events():
+            return root
+        return None
+    except ET.XMLSyntaxError as e:
+        logging.info("could not parse document %s", e)
+        return None
+    finally:
+        # Reset the parser for its next use. The root element outlives it,
+        # and whatever close() has to say about the rest doesn't matter.
+        try:
+            parser.close()
+        except ET.XMLSyntaxError:
+            pass
+        for _ in parser.read_events():
+            pass
+
+
+if sys.platform == "darwin":
+    # macOS file systems are usually case-insensitive, but normcase() leaves
+    # names alone there.
+    _file_name_key = str.casefold
+else:
+    # Folds case on Windows, and leaves names alone elsewhere.
+    _file_name_key = os.path.normcase
+
+
+def _xsd_files_in(search_dir, dir_index):
+    """
+    Returns {filename: path} for the .xsd files in a search directory.
+
+    File names are keyed by _file_name_key(), so they match as the platform's
+    file system usually does.
+
+    dir_index caches the listings as {dir: (mtime_ns, listing)}. A directory's
+    mtime changes whenever a file is added to, removed from, or renamed in it,
+    so one stat is enough to decide whether the listing is still good.
+    """
+    key = str(search_dir)
+    if not search_dir.is_dir():
+        return {}
+    mtime_ns = search_dir.stat().st_mtime_ns
+    cached = dir_index.get(key)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
+    with os.scandir(search_dir) as entries:
+        listing = {
+            name: entry.path
+            for entry in entries
+            if (name := _file_name_key(entry.name)).endswith(".xsd")
+            and entry.is_file()
+        }
+    dir_index[key] = (mtime_ns, listing)
+    return listing
+
+
+# The characters allowed in a root element name that is used as a file name.
+# \w matches exactly the alphanumeric characters plus "_".
+_ROOT_ELEMENT_NAME_RE = re.compile(r"[\w.-]+")
+
+
+@lru_cache(maxsize=64)
+def _resolve_dir(dir_path):
+    """
+    Returns the canonical absolute path of a configured search directory.
+
+    The search paths come from the locator options and are looked up on
+    every schema search, so each is resolved once rather than with a syscall
+    per path component every time.
+    """
+    return Path(dir_path).resolve()
+
+
+def _find_schemapath_by_rootelement(xml_doc, searchpaths, dir_index=None, misses=None):
+    """
+    Finds schema file path based on root element name.
+
+    misses, if given, remembers (root element name, search paths) pairs that
+    found nothing, so a document without a schema doesn't repeat the same
+    directory checks on every lookup. It should expire its entries, so that
+    a schema added later is found.
+    """
     root_element_name = xml_doc.tag
     
     # Extract local name from namespaced element names
@@ -33,34 +163,48 @@ def _find_schemapath_by_rootelement(xml_doc, searchpaths):
     
     # Security: Validate the root element name to prevent path traversal
     # Only allow alphanumeric characters, underscores, hyphens, and dots
-    if not root_element_name or not all(c.isalnum() or c in "._-" for c in root_element_name):
-        logging.warning(f"Invalid root element name: {root_element_name}")
+    if not _ROOT_ELEMENT_NAME_RE.fullmatch(root_element_name):
+        logging.warning("Invalid root element name: %s", root_element_name)
         return None
     
-    # Security: Prevent path traversal attempts
-    if ".." in root_element_name or "/" in root_element_name or "\\" in root_element_name:
-        logging.warning(f"Potential path traversal attempt in root element: {root_element_name}")
+    # Security: Prevent path traversal attempts; the name has no slashes.
+    if ".." in root_element_name:
+        logging.warning("Potential path traversal attempt in root element: %s", root_element_name)
         return None
     
+    miss_key = (root_element_name, tuple(searchpaths))
+    if misses is not None and miss_key in misses:
+        return None
+
+    if dir_index is None:
+        dir_index = {}
     for searchpath in searchpaths:
         try:
             # Resolve both paths to their canonical absolute paths
-            search_dir = Path(searchpath).resolve()
-            schema_file = (search_dir / f"{root_element_name}.xsd").resolve()
+            search_dir = _resolve_dir(searchpath)
+            xsd_file = _xsd_files_in(search_dir, dir_index).get(
+                _file_name_key(f"{root_element_name}.xsd")
+            )
+            if xsd_file is None:
+                continue
+            schema_file = Path(xsd_file).resolve()
             
             # Security: Ensure the resolved path is still within the search directory
-            if not str(schema_file).startswith(str(search_dir)):
-                logging.warning(f"Path traversal attempt detected: {schema_file}")
+            if not schema_file.is_relative_to(search_dir):
+                logging.warning("Path traversal attempt detected: %s", schema_file)
                 continue
-                
-            if schema_file.exists():
-                schema_path = str(schema_file)
-                logging.info(f"Found schema for {root_element_name} at {schema_path}")
-                return schema_path
+
+            # The directory listing only has files that existed when it was
+            # taken, and it is retaken whenever a file is added or removed.
+            schema_path = str(schema_file)
+            logging.info("Found schema for %s at %s", root_element_name, schema_path)
+            return schema_path
         except (OSError, ValueError) as e:
-            logging.error(f"Error resolving path in {searchpath}: {e}")
+            logging.error("Error resolving path in %s: %s", searchpath, e)
             continue
-    
+
+    if misses is not None:
+        misses[miss_key] = True
     return None
 
 
@@ -83,145 +227,434 @@ def _validate_schema_path(schema_path):
         
         # Security: Ensure it has a valid extension
         if schema_file.suffix.lower() not in ['.xsd', '.xml']:
-            logging.warning(f"Invalid schema file extension: {schema_file}")
+            logging.warning("Invalid schema file extension: %s", schema_file)
             return None
             
         return str(schema_file)
     except (OSError, ValueError) as e:
-        logging.error(f"Error validating schema path {schema_path}: {e}")
+        logging.error("Error validating schema path %s: %s", schema_path, e)
         return None
 
 
-def _find_schemapath_by_location_hint(xml_doc, map_path, doc_uri=None):
-    """Finds schema file path based on xsi:schemaLocation hint."""
-    XSI = "http://www.w3.org/2001/XMLSchema-instance"
-    schemaLocation_attr = f"{{{XSI}}}schemaLocation"
-    attr_value = xml_doc.attrib.get(schemaLocation_attr)
+def _matching_patterns(patterns, doc_filename, matchers):
+    """
+    Returns the items of a patterns locator whose glob matches doc_filename.
+
+    The globs are compiled into one regex, cached in matchers by the tuple of
+    globs, with an optional lookahead per glob. A single match then tells
+    which of them match, in their configured order.
+    """
+    globs = tuple(p.get("pattern") or "" for p in patterns)
+    matcher = matchers.get(globs)
+    if matcher is None:
+        matcher = matchers[globs] = re.compile(
+            "".join(
+                f"(?:(?=(?P<pattern{i}>{fnmatch.translate(os.path.normcase(g))})))?"
+                for i, g in enumerate(globs)
+                if g
+            )
+        )
+    match = matcher.match(os.path.normcase(doc_filename))
+    return [
+        p
+        for i, p in enumerate(patterns)
+        if globs[i] and match.group(f"pattern{i}") is not None
+    ]
+
+
+_XSI_SCHEMA_LOCATION = "{http://www.w3.org/2001/XMLSchema-instance}schemaLocation"
+
+
+def _resolve_schema_map_entry(searchpath, hint, schema_filename):
+    """
+    Returns the resolved path a schema map entry names, or None if it is unsafe.
+
+    The schema file must be a plain file name, in the map's own directory.
+    """
+    # Security: Validate schema_filename is a string
+    if not isinstance(schema_filename, str):
+        logging.warning("Invalid schema filename type for hint %s", hint)
+        return None
+    
+    # Security: Prevent path traversal in schema filename
+    if ".." in schema_filename or "/" in schema_filename or "\\" in schema_filename:
+        logging.warning("Potential path traversal in schema filename: %s", schema_filename)
+        return None
+    
+    try:
+        schema_file = (searchpath / schema_filename).resolve()
+        
+        # Security: Ensure the resolved path is still within the search directory
+        if not schema_file.is_relative_to(searchpath):
+            logging.warning("Path traversal attempt detected: %s", schema_file)
+            return None
+        return str(schema_file)
+    except (OSError, ValueError) as e:
+        logging.error("Error resolving schema path: %s", e)
+        return None
+
+
+def _read_schema_map(map_file, schema_maps):
+    """
+    Returns a schema map JSON file as {hint: resolved schema path}.
+
+    Every entry is checked and resolved as the file is read, and unsafe
+    ones are left out, so a lookup is just a dict get. schema_maps caches
+    the results as {path: (mtime_ns, schema_map)}, so the file gets read
+    again only after it changes.
+    """
+    key = str(map_file)
+    mtime_ns = map_file.stat().st_mtime_ns
+    cached = schema_maps.get(key)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
+    # json.loads decodes bytes itself, in one pass, faster than json.load
+    # reads a text stream.
+    raw_map = json.loads(map_file.read_bytes())
+
+    schema_map = {}
+    # Security: Ensure schema_map is a dictionary
+    if not isinstance(raw_map, dict):
+        logging.error("Invalid schema map format in %s", map_file)
+    else:
+        searchpath = map_file.parent
+        for hint, schema_filename in raw_map.items():
+            schema_path = _resolve_schema_map_entry(searchpath, hint, schema_filename)
+            if schema_path:
+                schema_map[hint] = schema_path
+    schema_maps[key] = (mtime_ns, schema_map)
+    return schema_map
+
+
+def _find_schemapath_by_location_hint(
+    xml_doc, map_path, doc_dir=None, schema_maps=None
+):
+    """
+    Finds schema file path based on xsi:schemaLocation hint.
+
+    file: hints are resolved relative to doc_dir, the resolved directory of
+    the document, if it is given.
+    """
+    attr_value = xml_doc.attrib.get(_XSI_SCHEMA_LOCATION)
     if not attr_value:
         return None
 
     hints = attr_value.split()
     
-    # If doc_uri is provided, try to resolve file: URIs relative to document location
-    if doc_uri:
-        try:
-            doc_path = Path(to_fs_path(doc_uri)).resolve()
-            doc_dir = doc_path.parent
-            
-            for hint in hints:
-                # Check if hint starts with "file:"
-                if hint.startswith("file:"):
-                    # Strip the "file:" prefix
-                    file_path = hint[5:]  # Remove "file:" prefix
-                    
+    # If doc_dir is provided, try to resolve file: URIs relative to document location
+    if doc_dir:
+        for hint in hints:
+            # Check if hint starts with "file:"
+            if hint.startswith("file:"):
+                try:
+                    # Take the path from the URI, decoding any %-escapes.
+                    # A relative one like "file:schema.xsd" is kept relative.
+                    file_path = url2pathname(urlparse(hint).path)
+
                     # Security: Basic validation of the file path
                     if not file_path:
                         continue
+
+                    # Resolve the path relative to the document directory;
+                    # joining leaves an absolute path as it is.
+                    schema_file = (doc_dir / file_path).resolve()
                     
-                    try:
-                        # Resolve the path relative to the document directory
-                        if Path(file_path).is_absolute():
-                            schema_file = Path(file_path).resolve()
-                        else:
-                            schema_file = (doc_dir / file_path).resolve()
-                        
-                        # Security: Validate the resolved path
-                        validated_path = _validate_schema_path(str(schema_file))
-                        if validated_path and Path(validated_path).exists():
-                            logging.info(
-                                f"Found schema from file: URI '{hint}' at {validated_path}"
-                            )
-                            return validated_path
-                    except (OSError, ValueError) as e:
-                        logging.error(f"Error resolving file: URI '{hint}': {e}")
-                        continue
-        except Exception as e:
-            logging.error(f"Error processing file: URIs for document {doc_uri}: {e}")
+                    # Security: Validate the resolved path, which also
+                    # checks that it is an existing file.
+                    validated_path = _validate_schema_path(str(schema_file))
+                    if validated_path:
+                        logging.info(
+                            "Found schema from file: URI '%s' at %s",
+                            hint,
+                            validated_path,
+                        )
+                        return validated_path
+                except (OSError, ValueError) as e:
+                    logging.error("Error resolving file: URI '%s': %s", hint, e)
+                    continue
     
     try:
         map_file = Path(map_path).resolve()
         if not map_file.exists():
             return None
             
-        with open(map_file, "r", encoding="utf-8") as f:
-            schema_map = json.load(f)
+        schema_map = _read_schema_map(
+            map_file, schema_maps if schema_maps is not None else {}
+        )
 
-        # Security: Ensure schema_map is a dictionary
-        if not isinstance(schema_map, dict):
-            logging.error(f"Invalid schema map format in {map_path}")
-            return None
+        for hint in hints:
+            schema_path = schema_map.get(hint)
+            if schema_path and os.path.isfile(schema_path):
+                logging.info("Found schema hint '%s' pointing to %s", hint, schema_path)
+                return schema_path
+    except (OSError, TypeError, ValueError) as e:
+        # ValueError covers a map that is not valid JSON, or not UTF-8, and
+        # TypeError a locationHint setting that is not a path.
+        logging.error("Error processing schema_map.json at %s: %s", map_path, e)
+    
+    return None
 
-        searchpath = map_file.parent
 
-        for hint in hints:
-            if hint in schema_map:
-                schema_filename = schema_map[hint]
-                
-                # Security: Validate schema_filename is a string
-                if not isinstance(schema_filename, str):
-                    logging.warning(f"Invalid schema filename type for hint {hint}")
-                    continue
-                
-                # Security: Prevent path traversal in schema filename
-                if ".." in schema_filename or "/" in schema_filename or "\\" in schema_filename:
-                    logging.warning(f"Potential path traversal in schema filename: {schema_filename}")
-                    continue
-                
-                try:
-                    schema_file = (searchpath / schema_filename).resolve()
-                    
-                    # Security: Ensure the resolved path is still within the search directory
-                    if not str(schema_file).startswith(str(searchpath)):
-                        logging.warning(f"Path traversal attempt detected: {schema_file}")
-                        continue
-                    
-                    if schema_file.exists():
-                        schema_path = str(schema_file)
-                        logging.info(
-                            f"Found schema hint '{hint}' pointing to {schema_path}"
-                        )
-                        return schema_path
-                except (OSError, ValueError) as e:
-                    logging.error(f"Error resolving schema path: {e}")
-                    continue
+def _schema_source_mtimes(schema):
+    """Returns {filepath: st_mtime_ns} for each file a compiled schema was built from."""
+    mtimes = {}
+    for component_schema in schema.maps.iter_schemas():
+        if component_schema.filepath:
+            mtimes[component_schema.filepath] = os.stat(
+                component_schema.filepath
+            ).st_mtime_ns
+    return mtimes
+
+
+def _load_schema(schema_path):
+    """
+    Returns the compiled XMLSchema11 for a schema file.
+
+    A pickled copy of the compiled schema is kept in the disk cache, named by
+    a digest of the schema path plus the schema file's mtime. Each entry also
+    records the mtimes of every included or imported schema file, and is
+    used only if none of them has changed since. It starts with the version
+    of xmlschema that compiled it, since another version may not be able to
+    use the pickled objects. Any problem reading or writing the cache falls
+    back to compiling the schema afresh.
+    """
+    digest = hashlib.sha1(schema_path.encode("utf-8")).hexdigest()
+    try:
+        mtime = os.stat(schema_path).st_mtime_ns
+    except OSError:
+        return xmlschema.XMLSchema11(schema_path)
+    cache_file = _SCHEMA_CACHE_DIR / f"{digest}.{mtime}.pkl"
+
+    if cache_file.exists():
+        try:
+            with open(cache_file, "rb") as f:
+                # The version is a record of its own, so that a schema
+                # pickled by another version is never unpickled.
+                if pickle.load(f) != xmlschema.__version__:
+                    source_mtimes, schema = None, None
+                else:
+                    source_mtimes, schema = pickle.load(f)
+            if source_mtimes is None:
+                logging.info(
+                    "Cached schema %s is from another xmlschema version", cache_file
+                )
+            elif all(
+                os.stat(path).st_mtime_ns == source_mtime
+                for path, source_mtime in source_mtimes.items()
+            ):
+                logging.info(
+                    "Loaded compiled schema %s from %s", schema_path, cache_file
+                )
+                return schema
+            else:
+                logging.info("Cached schema %s is out of date", cache_file)
+        except Exception as e:
+            logging.warning("Ignoring unreadable schema cache %s: %s", cache_file, e)
+
+    schema = xmlschema.XMLSchema11(schema_path)
+
+    try:
+        _SCHEMA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Drop entries for earlier versions of this schema file.
+        for stale_file in _SCHEMA_CACHE_DIR.glob(f"{digest}.*.pkl"):
+            stale_file.unlink(missing_ok=True)
+        tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump(xmlschema.__version__, f, protocol=5)
+            pickle.dump((_schema_source_mtimes(schema), schema), f, protocol=5)
+        os.replace(tmp_file, cache_file)
+        logging.info("Stored compiled schema %s in %s", schema_path, cache_file)
     except Exception as e:
-        logging.error(f"Error processing schema_map.json at {map_path}: {e}")
-    
+        logging.warning("Could not write schema cache %s: %s", cache_file, e)
+
+    return schema
+
+
+# Compiled schemas shared by all workspaces, as
+# {(realpath, st_mtime_ns): (source_mtimes, schema)}.
+_schema_pool = LRUCache(maxsize=32)
+_schema_pool_lock = threading.Lock()
+
+# Compiling a schema can take seconds, so it is done off the LSP thread.
+_schema_loader = ThreadPoolExecutor(max_workers=2, thread_name_prefix="schema-loader")
+
+
+def _schema_from_pool(schema_path):
+    """
+    Returns the pooled compiled schema for a schema file, or None.
+
+    A pooled schema is reused only if none of the files it was built from has
+    changed since, just like an entry in the disk cache.
+    """
+    realpath = os.path.realpath(schema_path)
+    key = (realpath, os.stat(realpath).st_mtime_ns)
+    with _schema_pool_lock:
+        pooled = _schema_pool.get(key)
+    if pooled is not None:
+        source_mtimes, schema = pooled
+        try:
+            if _schema_source_mtimes(schema) == source_mtimes:
+                logging.info("Reusing compiled schema %s", schema_path)
+                return schema
+        except OSError:
+            pass
     return None
 
 
+def _pooled_schema(schema_path):
+    """Returns the compiled schema for a schema file, shared across workspaces."""
+    schema = _schema_from_pool(schema_path)
+    if schema is not None:
+        return schema
+
+    realpath = os.path.realpath(schema_path)
+    key = (realpath, os.stat(realpath).st_mtime_ns)
+    schema = _load_schema(realpath)
+    # Completion indexes, one per default namespace. The completion code
+    # builds each one on first use.
+    schema._completion_index = {}
+    with _schema_pool_lock:
+        _schema_pool[key] = (_schema_source_mtimes(schema), schema)
+    return schema
+
+
+class _RefCountingLRUCache(LRUCache):
+    """
+    An LRUCache that counts how many keys map to each value.
+
+    The counts follow every way an entry can come or go, including the
+    evictions LRUCache makes on its own, so refcounts[value] is always the
+    number of keys currently mapping to value. Values must be hashable.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.refcounts = collections.Counter()
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._release(self[key])
+        super().__setitem__(key, value)
+        self.refcounts[value] += 1
+
+    def __delitem__(self, key):
+        value = self[key]
+        super().__delitem__(key)
+        self._release(value)
+
+    def _release(self, value):
+        self.refcounts[value] -= 1
+        if not self.refcounts[value]:
+            del self.refcounts[value]
+
+
 class Workspace:
     """Represents a single workspace folder."""
 
+    __slots__ = (
+        "root_uri",
+        "options",
+        "schemas_for_xsdpath",
+        "schemapaths_for_uri",
+        "default_xmlns_for_schemapath",
+        "schema_maps",
+        "schema_dir_index",
+        "root_element_misses",
+        "pattern_matchers",
+        "doc_paths",
+        "pending_schemas",
+        "lock",
+    )
+
     def __init__(self, root_uri, initialization_options):
         self.root_uri = root_uri
         self.options = initialization_options
-        self.schemas_for_xsdpath = {}  # schemapath -> schema object
-        self.schemapaths_for_uri = {}  # doc uri -> schemapath
+        # Documents that are never closed would otherwise keep these growing
+        # for the life of the server, and a compiled schema can be large.
+        self.schemas_for_xsdpath = LRUCache(maxsize=32)  # schemapath -> schema object
+        self.schemapaths_for_uri = _RefCountingLRUCache(maxsize=1024)  # doc uri -> schemapath
         self.default_xmlns_for_schemapath = {}  # schemapath -> default_xmlns
+        self.schema_maps = {}  # schema map json path -> (mtime_ns, {hint: schemapath})
+        self.schema_dir_index = {}  # search dir -> (mtime_ns, {filename: path})
+        # (root element name, search paths) -> True, for searches that found
+        # nothing in the last couple of seconds.
+        self.root_element_misses = TTLCache(maxsize=256, ttl=2)
+        self.pattern_matchers = {}  # tuple of globs -> compiled regex
+        self.doc_paths = LRUCache(maxsize=1024)  # doc uri -> (resolved path, filename)
+        self.pending_schemas = {}  # schemapath -> Future of the loading schema
+        # Guards the schema caches above, which schema-loader threads update.
+        self.lock = threading.RLock()
+
+    def _doc_path(self, uri):
+        """
+        Returns (resolved path, filename) for a document URI.
+
+        Resolving the path costs a syscall per path component, and the
+        locators ask for it on every schema lookup, so it is cached per URI.
+        """
+        with self.lock:
+            doc_path = self.doc_paths.get(uri)
+        if doc_path is None:
+            fs_path = to_fs_path(uri)
+            doc_path = (Path(fs_path).resolve(), os.path.basename(fs_path))
+            with self.lock:
+                self.doc_paths[uri] = doc_path
+        return doc_path
+
+    def cached_schema(self, uri):
+        """
+        Returns (schema, schemapath, default_xmlns) for a document, from the cache.
+
+        Any of the three can be None: schemapath without schema means the schema
+        has dropped out of the cache since it was found.
+        """
+        with self.lock:
+            schema_path = self.schemapaths_for_uri.get(uri)
+            if schema_path is None:
+                return None, None, None
+            return (
+                self.schemas_for_xsdpath.get(schema_path),
+                schema_path,
+                self.default_xmlns_for_schemapath.get(schema_path),
+            )
 
-    def get_schema_for_doc(self, uri, content):
+    def get_schema_for_doc(self, uri, content, on_loaded=None):
         """
         Finds, loads, and caches the schema for a given document.
 
         Updates the workspace state with the results of the schema search.
+        A schema that isn't compiled yet is loaded in the background; until
+        it is ready this returns (None, None, None), and once it is, on_loaded (if
+        given) is called from the loader thread with the schema, its path
+        and its default namespace.
+
+        Args:
+            uri: The document URI.
+            content: The document content, UTF-8 encoded.
+            on_loaded: Optional callable(schema, schema_path, default_xmlns).
 
         Returns:
-            A tuple of (xmlschema.XMLSchema, str) or (None, None).
+            A tuple of (xmlschema.XMLSchema, schema path, default namespace),
+            or (None, None, None). The default namespace may be None.
         """
-        parser = ET.XMLParser(recover=True)
-        try:
-            xml_doc = ET.fromstring(content.encode("utf-8"), parser)
-        except ET.XMLSyntaxError as e:
-            logging.info(f"could not parse document {e}")
-            return None, None  # Invalid XML, can't determine schema
-
         # Check cache first
-        if uri in self.schemapaths_for_uri:
-            schema_path = self.schemapaths_for_uri[uri]
-            if schema_path in self.schemas_for_xsdpath:
-                schema = self.schemas_for_xsdpath[schema_path]
-                return schema, schema_path
+        with self.lock:
+            if uri in self.schemapaths_for_uri:
+                schema_path = self.schemapaths_for_uri[uri]
+                if schema_path in self.schemas_for_xsdpath:
+                    schema = self.schemas_for_xsdpath[schema_path]
+                    return (
+                        schema,
+                        schema_path,
+                        self.default_xmlns_for_schemapath.get(schema_path),
+                    )
+
+        # The locators look only at the root element.
+        xml_doc = _peek_root_element(content)
+        if xml_doc is None:
+            logging.info("could not find a root element in %s", uri)
+            return None, None, None  # Invalid XML, can't determine schema
 
         locators = self.options.get("schemaLocators", [])
         if not locators:
@@ -233,91 +666,139 @@ class Workspace:
             if locator.get("rootElement") and locator.get("searchPaths"):
                 logging.info("Trying locator rootElement")
                 schema_path = _find_schemapath_by_rootelement(
-                    xml_doc, locator.get("searchPaths")
+                    xml_doc,
+                    locator.get("searchPaths"),
+                    self.schema_dir_index,
+                    self.root_element_misses,
                 )
             elif locator.get("locationHint"):
                 logging.info("Trying locator locationHint")
+                try:
+                    doc_dir = self._doc_path(uri)[0].parent
+                except (OSError, ValueError) as e:
+                    logging.error("Error resolving path of %s: %s", uri, e)
+                    doc_dir = None
                 schema_path = _find_schemapath_by_location_hint(
-                    xml_doc, locator.get("locationHint"), uri
+                    xml_doc, locator.get("locationHint"), doc_dir, self.schema_maps
                 )
             elif "patterns" in locator:
                 logging.info("Trying locator patterns")
                 patterns = locator.get("patterns", [])
-                doc_filename = os.path.basename(to_fs_path(uri))
-                for p in patterns:
+                doc_filename = self._doc_path(uri)[1]
+                for p in _matching_patterns(
+                    patterns, doc_filename, self.pattern_matchers
+                ):
                     pattern = p.get("pattern")
-                    if pattern and fnmatch.fnmatch(doc_filename, pattern):
-                        raw_schema_path = p.get("path")
-                        if raw_schema_path:
-                            # Security: Validate the schema path
-                            schema_path = _validate_schema_path(raw_schema_path)
-                            if schema_path:
-                                logging.info(
-                                    f"Pattern '{pattern}' matched '{doc_filename}',"
-                                    f" using schema '{schema_path}'"
-                                )
-                                use_default_namespace = p.get("useDefaultNamespace")
-                                break
-                            else:
-                                logging.warning(f"Invalid schema path from pattern: {raw_schema_path}")
-                                schema_path = None
+                    raw_schema_path = p.get("path")
+                    if raw_schema_path:
+                        # Security: Validate the schema path
+                        schema_path = _validate_schema_path(raw_schema_path)
+                        if schema_path:
+                            logging.info(
+                                "Pattern '%s' matched '%s', using schema '%s'",
+                                pattern,
+                                doc_filename,
+                                schema_path,
+                            )
+                            use_default_namespace = p.get("useDefaultNamespace")
+                            break
+                        else:
+                            logging.warning("Invalid schema path from pattern: %s", raw_schema_path)
+                            schema_path = None
             else:
-                logging.warning(f"Unrecognized locator type {locator}")
+                logging.warning("Unrecognized locator type %s", locator)
 
             if schema_path:
                 try:
-                    xsd_root = ET.parse(schema_path).getroot()
-                    schema = xmlschema.XMLSchema11(schema_path)
-                    logging.info(f"Successfully loaded schema {schema_path}")
-
-                    # Stash it
-                    self.schemas_for_xsdpath[schema_path] = schema
-                    self.schemapaths_for_uri[uri] = schema_path
-
-                    # If the useDefaultNamespace flag has been set on this
-                    # locator, get the targetNamespace for this schema and stash
-                    # it. Purpose: to handle cases where people want to ignore
-                    # xmlns with documents.  Sounds amateur, but there's a big
-                    # example: Microsoft with their MSBuild project files. The
-                    # xml uses no namespace, but the schema are in the msbuild
-                    # namespace. We CAN use xmlschema to validate such
-                    # documents, basically telling it "assume this namespace as
-                    # you validate, even though it's not declared in the
-                    # document." For that we need to know/retain the target
-                    # namespace.
-                    #
-                    # This useDefaultNamespace works only with the patterns locator.
-                    if use_default_namespace:
-                        target_namespace = xsd_root.get("targetNamespace")
-                        if target_namespace:
-                            self.default_xmlns_for_schemapath[schema_path] = (
-                                target_namespace
-                            )
+                    schema = _schema_from_pool(schema_path)
+                except OSError as e:
+                    logging.error("Failed to load schema %s: %s", schema_path, e)
+                    return None, None, None
+                if schema is None:
+                    self._load_schema_in_background(
+                        uri, schema_path, use_default_namespace, on_loaded
+                    )
+                    return None, None, None
+                default_xmlns = self._stash_schema(
+                    uri, schema_path, schema, use_default_namespace
+                )
+                return schema, schema_path, default_xmlns
 
-                    return schema, schema_path
-                except Exception as e:
-                    logging.error(f"Failed to load schema {schema_path}: {e}")
-                    return None, None
+        logging.warning("No schema located for %s", uri)
+        return None, None, None
 
-        logging.warning(f"No schema located for {uri}")
-        return None, None
+    def _stash_schema(self, uri, schema_path, schema, use_default_namespace):
+        """Records a loaded schema as the schema for a document."""
+        logging.info("Successfully loaded schema %s", schema_path)
+        with self.lock:
+            self.schemas_for_xsdpath[schema_path] = schema
+            self.schemapaths_for_uri[uri] = schema_path
 
-    def release_document(self, uri):
-        """Releases a document and cleans up unused schemas from the cache."""
-        logging.info(f"Releasing document: {uri}")
-        if uri in self.schemapaths_for_uri:
-            schema_path = self.schemapaths_for_uri.pop(uri)
-            logging.info(
-                f"Document {uri} closed; schemapath {schema_path} no longer used by it."
+            # If the useDefaultNamespace flag has been set on this locator,
+            # stash the targetNamespace of this schema. Purpose: to handle
+            # cases where people want to ignore xmlns with documents. Sounds
+            # amateur, but there's a big example: Microsoft with their MSBuild
+            # project files. The xml uses no namespace, but the schema are in
+            # the msbuild namespace. We CAN use xmlschema to validate such
+            # documents, basically telling it "assume this namespace as you
+            # validate, even though it's not declared in the document." For
+            # that we need to know/retain the target namespace.
+            #
+            # This useDefaultNamespace works only with the patterns locator.
+            if use_default_namespace and schema.target_namespace:
+                self.default_xmlns_for_schemapath[schema_path] = (
+                    schema.target_namespace
+                )
+            return self.default_xmlns_for_schemapath.get(schema_path)
+
+    def _load_schema_in_background(
+        self, uri, schema_path, use_default_namespace, on_loaded
+    ):
+        """Compiles a schema on a loader thread, then stashes it for the document."""
+        with self.lock:
+            future = self.pending_schemas.get(schema_path)
+            if future is None:
+                logging.info("Loading schema %s in the background", schema_path)
+                future = _schema_loader.submit(_pooled_schema, schema_path)
+                self.pending_schemas[schema_path] = future
+
+        def loaded(future):
+            with self.lock:
+                self.pending_schemas.pop(schema_path, None)
+            try:
+                schema = future.result()
+            except Exception as e:
+                logging.error("Failed to load schema %s: %s", schema_path, e)
+                return
+            default_xmlns = self._stash_schema(
+                uri, schema_path, schema, use_default_namespace
             )
+            if on_loaded:
+                on_loaded(schema, schema_path, default_xmlns)
 
-            # Check if any other open documents use this schema
-            if schema_path not in self.schemapaths_for_uri.values():
+        future.add_done_callback(loaded)
+
+    def release_document(self, uri):
+        """Releases a document and cleans up unused schemas from the cache."""
+        logging.info("Releasing document: %s", uri)
+        with self.lock:
+            self.doc_paths.pop(uri, None)
+            if uri in self.schemapaths_for_uri:
+                schema_path = self.schemapaths_for_uri.pop(uri)
                 logging.info(
-                    f"Schema {schema_path} is no longer used by any open document."
+                    "Document %s closed; schemapath %s no longer used by it.",
+                    uri,
+                    schema_path,
                 )
-                if schema_path in self.schemas_for_xsdpath:
-                    self.schemas_for_xsdpath.pop(schema_path)
-                    logging.info(f"Removed schema {schema_path} from cache.")
-                if schema_path in self.default_xmlns_for_schemapath:
-                    self.default_xmlns_for_schemapath.pop(schema_path, None)
+
+                # Check if any other open documents use this schema
+                if not self.schemapaths_for_uri.refcounts[schema_path]:
+                    logging.info(
+                        "Schema %s is no longer used by any open document.",
+                        schema_path,
+                    )
+                    if schema_path in self.schemas_for_xsdpath:
+                        self.schemas_for_xsdpath.pop(schema_path)
+                        logging.info("Removed schema %s from cache.", schema_path)
+                    if schema_path in self.default_xmlns_for_schemapath:
+                        self.default_xmlns_for_schemapath.pop(schema_path, None)
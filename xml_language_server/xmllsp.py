@@ -14,16 +14,24 @@
 #
 
 import argparse
+import hashlib
+import heapq
 import logging
+import multiprocessing
 import os
 import re
 import sys
 import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import accumulate
 from pathlib import Path
 
 import lxml.etree as ET
 import xmlschema
-from cachetools import TTLCache
+from cachetools import LRUCache
 from lsprotocol.types import (
     CompletionItem,
     CompletionItemKind,
@@ -38,17 +46,66 @@ from pygls.uris import to_fs_path
 
 # Handle both running as a module and as a script
 try:
-    from .workspace import Workspace
+    from .workspace import Workspace, _pooled_schema
 except ImportError:
-    from workspace import Workspace
+    from workspace import Workspace, _pooled_schema
 
 server = LanguageServer("xml-language-server", "v0.2")
 server.workspaces = {}
+server.workspaces_by_uri = LRUCache(maxsize=1024)
+
+
+# Matches a complete start or end tag, capturing the "/" of an end tag, the
+# tag name and the attributes. Quoted attribute values may contain ">".
+_TAG_RE = re.compile(rb"""<(/?)([^\s/>!?<]+)((?:[^<>"']|"[^"]*"|'[^']*')*)>""")
+
+# Matches a namespace declaration within the attributes of a start tag.
+_XMLNS_RE = re.compile(rb"""\sxmlns(?::([^\s=]+))?\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+# Where xmlschema and lxml put useful positions into their error messages.
+_POS_RE = re.compile(r"position (\d+)")
+_LINE_COL_RE = re.compile(r": line (\d+), column (\d+)")
+
+# Markup that may contain "<" and that completion scanning must step over,
+# as (terminator, opener) pairs.
+_OPAQUE_MARKUP = ((b"-->", b"<!--"), (b"]]>", b"<![CDATA["), (b"?>", b"<?"))
 
 
 # Cache for storing document-specific sessions
-# Sessions expire after 180 seconds of inactivity
-session_cache = TTLCache(maxsize=128, ttl=180)
+# Sessions live until didClose; the least recently used ones are evicted
+# only if the open documents outgrow this many bytes.
+_SESSION_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def _session_size(session):
+    """
+    Estimates the memory held by a session, for the session cache's bound.
+
+    The parsed lxml tree of a document typically takes a few times the size
+    of its text, so count the buffer five times over. The cache refuses
+    entries larger than itself; a huge document gets the whole cache instead.
+    """
+    return min(5 * len(session.get("buf", b"")), _SESSION_CACHE_BYTES)
+
+
+session_cache = LRUCache(maxsize=_SESSION_CACHE_BYTES, getsizeof=_session_size)
+
+
+def _new_session(content):
+    """
+    Creates the session state for a document.
+
+    The document is held as a UTF-8 bytearray, which edits splice in place.
+    The lock guards the buffer and the version counter, which are touched both
+    by didChange handlers and by the validation worker thread. The version is
+    bumped on every edit, so a deferred validation can tell that it has gone
+    stale.
+    """
+    return {
+        "buf": bytearray(content.encode("utf-8")),
+        "lock": threading.Lock(),
+        "version": 0,
+    }
 
 
 def _validate_file_uri(uri):
@@ -71,12 +128,12 @@ def _validate_file_uri(uri):
         
         # Security: Ensure the file has an XML extension
         if resolved_path.suffix.lower() not in ['.xml', '.xsd', '.csproj', '.pom', '.wsdl', '.xsl', '.xslt', '']:
-            logging.warning(f"Unexpected file extension for XML document: {resolved_path}")
+            logging.warning("Unexpected file extension for XML document: %s", resolved_path)
             # Still allow it but log warning
         
         return str(resolved_path)
     except (OSError, ValueError) as e:
-        logging.error(f"Error validating file URI {uri}: {e}")
+        logging.error("Error validating file URI %s: %s", uri, e)
         return None
 
 
@@ -89,12 +146,34 @@ def initialize(ls, params):
     root_uri = params.root_uri
 
     if root_uri:
-        logging.info(f"Workspace root: {root_uri}")
+        logging.info("Workspace root: %s", root_uri)
         ls.workspaces[root_uri] = Workspace(root_uri, initialization_options)
+        ls.workspaces_by_uri.clear()
 
     return None
 
 
+def _workspace_for_uri(ls, uri):
+    """
+    Returns the workspace that contains a document, or None.
+
+    The workspace is the one with the longest root URI that the document URI
+    is under, so documents in subdirectories of a workspace root belong to
+    it too. The answer is cached per document URI.
+    """
+    if uri in ls.workspaces_by_uri:
+        return ls.workspaces_by_uri[uri]
+
+    workspace = None
+    longest = -1
+    for root_uri, candidate in ls.workspaces.items():
+        root = root_uri.rstrip("/")
+        if len(root) > longest and uri.startswith(root + "/"):
+            workspace, longest = candidate, len(root)
+    ls.workspaces_by_uri[uri] = workspace
+    return workspace
+
+
 @server.feature("workspace/didChangeConfiguration")
 def did_change_configuration(ls, params):
     """Configuration changed."""
@@ -102,131 +181,285 @@ def did_change_configuration(ls, params):
     pass
 
 
-def _pos_to_offset2(content: str, pos: Position) -> int:
-    """Convert line/character position to a string offset."""
-    lines = content.splitlines(True)
-    if not lines:
-        lines = [""]
-    return _pos_to_offset(lines, pos)
+def _ends_with_line_break(text) -> bool:
+    """True if text (str or bytes) ends with a line boundary, as splitlines sees it."""
+    return text[-1:].splitlines() == [text[:0]]
 
 
-def _pos_to_offset(lines: list[str], pos: Position) -> int:
-    """Convert line/character position to a string offset."""
-    offset = 0
-    for i in range(pos.line):
-        offset += len(lines[i])
-    return offset + pos.character
+def _line_starts(content) -> array:
+    """
+    Returns an array of the offsets at which each line of content starts.
 
+    content may be a str or a bytes-like buffer, and lines are split the way
+    its splitlines method splits them; for bytes that is exactly the LSP set
+    of line breaks (LF, CRLF, CR). The array is built entirely by C-level
+    iteration; the first entry is always 0.
+    """
+    line_starts = array("i", accumulate(map(len, content.splitlines(True)), initial=0))
+    if len(line_starts) > 1 and not _ends_with_line_break(content):
+        # The last entry is the end of the content, not the start of a line.
+        line_starts.pop()
+    return line_starts
+
+
+def _splice_line_starts(
+    line_starts: array,
+    start_line: int,
+    end_line: int,
+    start_offset: int,
+    end_offset: int,
+    text: bytes,
+) -> None:
+    """
+    Updates line_starts in place after text replaced start_offset..end_offset.
 
-def _apply_incremental_changes(content: str, changes: list) -> str:
-    """Apply incremental changes to the document content."""
+    Only the lines inside the replaced range are recomputed; the starts of
+    the lines after it are shifted by the change in length.
+    """
+    delta = len(text) - (end_offset - start_offset)
+    inserted = array("i", map(start_offset.__add__, _line_starts(text)[1:]))
+    shifted = array("i", map(delta.__add__, line_starts[end_line + 1 :]))
+    line_starts[start_line + 1 :] = inserted + shifted
+
+
+def _pos_to_byte_offset(buf: bytearray, line_starts: array, pos: Position) -> int:
+    """Convert line/character position to an offset into a UTF-8 buffer."""
+    if pos.line >= len(line_starts):
+        # A range may end on the line after the last one, even when the
+        # document has no final newline.
+        return len(buf)
+    line_start = line_starts[pos.line]
+    if not pos.character:
+        return line_start
+    if pos.line + 1 < len(line_starts):
+        line = buf[line_start : line_starts[pos.line + 1]]
+    else:
+        line = buf[line_start:]
+    if line.isascii():
+        return line_start + pos.character
+    return line_start + len(line.decode("utf-8")[: pos.character].encode("utf-8"))
+
+
+def _session_line_starts(session) -> array:
+    """Returns the line index of a session's buffer, building it if need be."""
+    line_starts = session.get("line_starts")
+    if line_starts is None:
+        line_starts = session["line_starts"] = _line_starts(session["buf"])
+    return line_starts
+
+
+def _apply_incremental_changes(session, changes: list) -> None:
+    """Apply incremental changes, in place, to the session's UTF-8 buffer."""
+    buf = session["buf"]
+    # The line index is kept in the session and patched as each change is
+    # applied, so it is only ever rebuilt after a full content update or an
+    # edit next to a "\r".
+    line_starts = session.get("line_starts")
     for change in changes:
+        text = change.text.encode("utf-8")
         if not hasattr(change, "range") or change.range is None:
-            # Full content update
-            return change.text
+            # Full content update; any following changes apply to this text.
+            buf[:] = text
+            line_starts = None
+            continue
 
-        lines = content.splitlines(True)
-        if not lines:
-            lines = [""]
+        if line_starts is None:
+            line_starts = _line_starts(buf)
 
-        start_offset = _pos_to_offset(lines, change.range.start)
-        end_offset = _pos_to_offset(lines, change.range.end)
+        start_offset = _pos_to_byte_offset(buf, line_starts, change.range.start)
+        end_offset = _pos_to_byte_offset(buf, line_starts, change.range.end)
 
-        content = content[:start_offset] + change.text + content[end_offset:]
-    return content
+        # A "\r" next to the edit could pair up with a "\n" into a single
+        # line break, which patching cannot account for; rebuild instead.
+        if buf[start_offset - 1 : start_offset] == b"\r" or text.endswith(b"\r"):
+            line_starts = None
+        else:
+            _splice_line_starts(
+                line_starts,
+                change.range.start.line,
+                change.range.end.line,
+                start_offset,
+                end_offset,
+                text,
+            )
 
+        # Splicing in place moves only the tail of the buffer, rather than
+        # copying the whole document into a new string.
+        buf[start_offset:end_offset] = text
 
-def _find_element_at_position(element, line):
-    """Recursively find the deepest element at a given line number (1-based)."""
-    candidate = None
-    if (
-        hasattr(element, "sourceline")
-        and element.sourceline
-        and element.sourceline <= line
-    ):
-        candidate = element
-        for child in element:
-            child_candidate = _find_element_at_position(child, line)
-            if child_candidate is not None:
-                candidate = child_candidate
-    return candidate
+    session["line_starts"] = line_starts
 
 
-def _validate_document(ls, uri, content, schema, default_xmlns):
-    """Validate the document against the schema."""
-    if not schema:
-        logging.info("No schema available, skipping validation.")
-        ls.publish_diagnostics(uri, [])
-        return
+# lxml parsers can be reused for any number of parses, but not from two
+# threads at once, so each thread keeps its own.
+_parsers = threading.local()
+
+
+def _validation_parser():
+    """
+    Returns this thread's parser for documents about to be validated.
+
+    Session buffers are always UTF-8, so the parser is told so rather than
+    trusting the document's encoding declaration. libxml2's own xml:id table
+    is not collected, since xmlschema checks IDs itself, and huge_tree lifts
+    libxml2's limits on very large documents.
+    Comments and processing instructions are dropped: validation skips them
+    anyway, and they would only take up memory in the cached tree.
+    """
+    parser = getattr(_parsers, "validate", None)
+    if parser is None:
+        parser = _parsers.validate = ET.XMLParser(
+            encoding="utf-8",
+            collect_ids=False,
+            huge_tree=True,
+            remove_comments=True,
+            remove_pis=True,
+        )
+    return parser
+
+
+def _parse_document(session):
+    """
+    Returns the lxml tree for the current content of a session.
+
+    The tree is cached in the session alongside the version of the content
+    it was built from, so each version of the document is parsed at most once
+    no matter how many validations run against it. Raises ET.XMLSyntaxError
+    if the content is not well-formed.
+    """
+    with session["lock"]:
+        version = session["version"]
+        cached = session.get("xml_doc")
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        content = bytes(session["buf"])
+
+    xml_doc = ET.fromstring(content, _validation_parser())
+    session["xml_doc"] = (version, xml_doc)
+    return xml_doc
+
 
+# The most schema validation errors reported for one document.
+_MAX_DIAGNOSTICS = 100
+
+
+@lru_cache(maxsize=4096)
+def _point_range(line, character):
+    """
+    Returns the empty Range at a 0-based line and character.
+
+    Diagnostics are only ever placed at a point, and a noisy document puts
+    many of them on the same few lines, so the Range is shared rather than
+    built afresh for each one. Nothing modifies a Range once it is made.
+    """
+    pos = Position(line=line, character=character)
+    return Range(start=pos, end=pos)
+
+
+def _error_to_diagnostic(error):
+    """Converts an xmlschema validation error to an LSP Diagnostic."""
+    # Each attribute is read once; getattr with a default costs one lookup,
+    # where hasattr followed by the access costs two.
+    sourceline = getattr(error, "sourceline", None)
+    reason = getattr(error, "reason", None)
+    elem = getattr(error, "elem", None)
+    logging.info(
+        "Schema validation error: %s\n  at line=%s\n  path: %s\n  reason: %s",
+        error.message,
+        sourceline,
+        getattr(error, "path", None),
+        reason,
+    )
+
+    # The xmlschema library provides 1-based line/column numbers.
+    line, column = 1, 1
+
+    # error.sourceline is the line number of the element that the error
+    # is associated with. For child validation errors, this is the parent.
+    if sourceline:
+        line = sourceline
+
+    # For errors about unexpected children, we can get a more precise line number.
+    # Children validation errors carry the offending child; for any other
+    # error that names a child position, look the child up in the parent.
+    invalid_child = getattr(error, "invalid_child", None)
+    if invalid_child is not None:
+        child_line = getattr(invalid_child, "sourceline", None)
+        if child_line:
+            line = child_line
+    elif reason and elem is not None and "position " in reason:
+        match = _POS_RE.search(reason)
+        if match:
+            position = int(match.group(1))  # 1-based index
+            try:
+                # The 'elem' attribute on the error is the parent element.
+                # Children can be accessed by index.
+                child_line = getattr(elem[position - 1], "sourceline", None)
+                if child_line:
+                    line = child_line
+            except IndexError:
+                pass  # child not found, use parent's line number
+
+    # LSP positions are 0-based.
+    return Diagnostic(
+        range=_point_range(line - 1, column - 1),
+        message=reason or error.message,
+        severity=DiagnosticSeverity.Error,
+    )
+
+
+def _document_diagnostics(uri, parse, schema, default_xmlns):
+    """
+    Returns the diagnostics for a document validated against the schema.
+
+    parse is called with no arguments to get the lxml tree of the document;
+    it may raise ET.XMLSyntaxError, which is reported as a diagnostic.
+    """
     try:
-        # xml_doc = ET.fromstring(content.encode("utf-8"))
-        # validation_errors = list(schema.iter_errors(xml_doc))
         # Using XMLResource allows caller to specify a default namespace if desired.
+        xml_doc = parse()
         if default_xmlns:
-            logging.info(f"applying default namespace {default_xmlns}")
-            xml_resource = xmlschema.XMLResource(content, namespace=default_xmlns)
+            logging.info("applying default namespace %s", default_xmlns)
+            xml_resource = xmlschema.XMLResource(xml_doc, namespace=default_xmlns)
         else:
-            logging.info(f"Using normal namespace rules")
-            xml_resource = xmlschema.XMLResource(content)
+            logging.info("Using normal namespace rules")
+            xml_resource = xmlschema.XMLResource(xml_doc)
 
-        validation_errors = list(schema.iter_errors(xml_resource))
-
-        if not validation_errors:
-            logging.info(f"Validation successful for {uri}: No errors found.")
-            ls.publish_diagnostics(uri, [])
+        # Only the errors are wanted, so skip filling in default values for
+        # missing attributes and empty elements as the tree is walked. A
+        # document in the middle of an edit can have a great many errors;
+        # stop validating once there are more than anyone will read.
+        diagnostics = []
+        for error in schema.iter_errors(xml_resource, use_defaults=False):
+            if len(diagnostics) >= _MAX_DIAGNOSTICS:
+                logging.info("Stopping validation after %s errors.", _MAX_DIAGNOSTICS)
+                break
+            diagnostics.append(_error_to_diagnostic(error))
+
+        if not diagnostics:
+            logging.info("Validation successful for %s: No errors found.", uri)
         else:
-            diagnostics = []
-            for error in validation_errors:
-                # The xmlschema library provides 1-based line/column numbers.
-                # LSP positions are 0-based.
-                logging.info(f"Schema validation error: {error.message}")
-
-                line, column = 1, 1
-
-                # error.sourceline is the line number of the element that the error
-                # is associated with. For child validation errors, this is the parent.
-                if hasattr(error, "sourceline") and error.sourceline:
-                    line = error.sourceline
-                    logging.info(f"  at line={error.sourceline}")
-
-                if hasattr(error, "path"):
-                    logging.info(f"  path: {error.path}")
-
-                # For errors about unexpected children, we can get a more precise line number.
-                if hasattr(error, "reason") and hasattr(error, "elem"):
-                    logging.info(f"  reason: {error.reason}")
-                    match = re.search(r"position (\d+)", error.reason)
-                    if match:
-                        position = int(match.group(1))  # 1-based index
-                        try:
-                            # The 'elem' attribute on the error is the parent element.
-                            # Children can be accessed by index.
-                            child_element = error.elem[position - 1]
-                            if (
-                                hasattr(child_element, "sourceline")
-                                and child_element.sourceline
-                            ):
-                                line = child_element.sourceline
-                        except IndexError:
-                            pass  # child not found, use parent's line number
-
-                # LSP positions are 0-based.
-                pos = Position(line=line - 1, character=column - 1)
-
-                diagnostic = Diagnostic(
-                    range=Range(start=pos, end=pos),
-                    message=error.reason or error.message,
-                    severity=DiagnosticSeverity.Error,
-                )
-                diagnostics.append(diagnostic)
-
-            logging.warning(f"Validation of {uri} found {len(diagnostics)} errors.")
-            ls.publish_diagnostics(uri, diagnostics)
+            logging.warning("Validation of %s found %s errors.", uri, len(diagnostics))
+        return diagnostics
+    except ET.XMLSyntaxError as e:
+        # Not well-formed; libxml2 reports 1-based line and column numbers.
+        line, column = e.position
+        diagnostic = Diagnostic(
+            range=_point_range(max(line - 1, 0), max(column - 1, 0)),
+            message=e.msg,
+            severity=DiagnosticSeverity.Error,
+        )
+        logging.error("Error during validation of %s: %s", uri, e, exc_info=False)
+        return [diagnostic]
+    except xmlschema.XMLSchemaValidationError as e:
+        # Raised rather than yielded, but it knows its own location.
+        logging.error("Error during validation of %s: %s", uri, e, exc_info=False)
+        return [_error_to_diagnostic(e)]
     except Exception as e:
+        # Anything else may at best name a position in its message.
         msg = str(e)
         diagnostics = []
-        match = re.search(r": line (\d+), column (\d+)", msg)
+        match = _LINE_COL_RE.search(msg)
 
         if match:
             line = int(match.group(1))
@@ -234,178 +467,450 @@ def _validate_document(ls, uri, content, schema, default_xmlns):
             error_message = msg[: match.start()]
 
             # LSP positions are 0-based.
-            pos = Position(line=line - 1, character=column - 1)
-
             diagnostic = Diagnostic(
-                range=Range(start=pos, end=pos),
+                range=_point_range(line - 1, column - 1),
                 message=error_message,
                 severity=DiagnosticSeverity.Error,
             )
             diagnostics.append(diagnostic)
 
+        logging.error("Error during validation of %s: %s", uri, e, exc_info=False)
+        return diagnostics
+
+
+def _content_digest(content):
+    """Returns a digest of a document's UTF-8 content, to recognize it again."""
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+def _known_diagnostics(session, digest, schema, default_xmlns):
+    """
+    Returns the diagnostics last found for this content and schema, or None.
+
+    An edit followed by its undo, or a save, leaves a document with the same
+    content it was last validated with; there is no need to validate it again.
+    """
+    validated = session.get("validated")
+    if (
+        validated is not None
+        and validated[0] == digest
+        and validated[1] is schema
+        and validated[2] == default_xmlns
+    ):
+        return validated[3]
+    return None
+
+
+def _remember_diagnostics(session, version, digest, schema, default_xmlns, diagnostics):
+    """Records diagnostics for the session's content, if it is still at version."""
+    with session["lock"]:
+        if session["version"] == version:
+            session["validated"] = (digest, schema, default_xmlns, diagnostics)
+
+
+def _validate_document(ls, uri, session, schema, default_xmlns):
+    """Validate the document held in the session against the schema."""
+    if not schema:
+        logging.info("No schema available, skipping validation.")
+        ls.publish_diagnostics(uri, [])
+        return
+
+    with session["lock"]:
+        version = session["version"]
+        digest = _content_digest(session["buf"])
+    diagnostics = _known_diagnostics(session, digest, schema, default_xmlns)
+    if diagnostics is not None:
+        logging.info("Content of %s is unchanged since it was validated.", uri)
         ls.publish_diagnostics(uri, diagnostics)
-        logging.error(f"Error during validation of {uri}: {e}", exc_info=False)
+        return
+
+    # Validate the tree already parsed for this version of the content,
+    # rather than handing xmlschema the text to parse all over again.
+    diagnostics = _document_diagnostics(
+        uri, lambda: _parse_document(session), schema, default_xmlns
+    )
+    # The tree is parsed from whatever version is current by then; the
+    # diagnostics match the digest only if no edit came in meanwhile.
+    _remember_diagnostics(session, version, digest, schema, default_xmlns, diagnostics)
+    ls.publish_diagnostics(uri, diagnostics)
+
+
+# Set by main() when validation should run in worker processes. xmlschema
+# validates in pure Python, holding the GIL, so validating a big document in a
+# thread still stalls completion requests on the main thread.
+_validation_pool = None
+
+
+def _validate_in_worker_process(uri, content, schema_path, default_xmlns):
+    """Runs in a validation worker process; returns the diagnostics."""
+    # The worker loads the schema through its own pool, which is normally
+    # filled from the compiled-schema disk cache.
+    schema = _pooled_schema(schema_path)
+    return _document_diagnostics(
+        uri,
+        lambda: ET.fromstring(content, _validation_parser()),
+        schema,
+        default_xmlns,
+    )
 
 
 @server.feature("textDocument/didOpen")
 def did_open(ls, params):
     """Document opened."""
     uri = params.text_document.uri
-    logging.info(f"didOpen: {uri}, creating session.")
+    logging.info("didOpen: %s, creating session.", uri)
     content = params.text_document.text
-    session_cache[uri] = {"content": content}
+    session = _new_session(content)
+    session_cache[uri] = session
 
-    root_uri = uri.rpartition("/")[0]
-    workspace = ls.workspaces.get(root_uri)
+    workspace = _workspace_for_uri(ls, uri)
     if not workspace:
-        logging.warning(f"No workspace for {uri}")
+        logging.warning("No workspace for %s", uri)
         return
 
-    schema, schema_path = workspace.get_schema_for_doc(uri, content)
+    schema, schema_path, default_namespace = workspace.get_schema_for_doc(
+        uri, session["buf"], on_loaded=_validate_once_loaded(ls, uri)
+    )
 
-    default_namespace = None
-    if schema_path:
-        default_namespace = workspace.default_xmlns_for_schemapath.get(schema_path)
+    if not schema:
+        logging.info("No schema available, skipping validation.")
+        ls.publish_diagnostics(uri, [])
+        return
+
+    # Validate on the worker thread straight away, rather than here, where
+    # a long validation would hold up every other request.
+    _schedule_validation(
+        ls, uri, schema, schema_path, default_namespace, session["version"], delay=0
+    )
+
+
+# Deferred validations waiting for typing to pause, latest wins per URI, as
+# {uri: (deadline, ls, schema, schema_path, default_xmlns, version)}. A single
+# worker thread runs them as their deadlines pass.
+_VALIDATION_DELAY = 0.15
+_pending_validations = {}
+_pending_validations_cond = threading.Condition()
+# A min-heap of (deadline, uri), so the worker finds the next validation due
+# without scanning every pending one. Rescheduling or cancelling doesn't
+# remove the old entry; it is dropped when it comes up and no longer matches
+# the deadline in _pending_validations.
+_validation_deadlines = []
+
+
+def _validation_worker():
+    """Runs deferred validations from _pending_validations, forever."""
+    while True:
+        with _pending_validations_cond:
+            while True:
+                if _validation_deadlines:
+                    deadline, uri = _validation_deadlines[0]
+                    pending = _pending_validations.get(uri)
+                    if pending is None or pending[0] != deadline:
+                        heapq.heappop(_validation_deadlines)  # superseded
+                        continue
+                    delay = deadline - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(_validation_deadlines)
+                        break
+                else:
+                    delay = None
+                _pending_validations_cond.wait(delay)
+            pending = _pending_validations.pop(uri)
+            _, ls, schema, schema_path, default_xmlns, version = pending
+
+        logging.info("Running deferred validation for %s.", uri)
+        session = session_cache.get(uri)
+        if not session or "buf" not in session:
+            logging.warning("No content found for %s in deferred validation.", uri)
+            continue
+        with session["lock"]:
+            if session["version"] != version:
+                logging.info("Skipping stale deferred validation for %s.", uri)
+                continue
+            content = bytes(session["buf"]) if _validation_pool else None
+        try:
+            if content is None:
+                _validate_document(ls, uri, session, schema, default_xmlns)
+                continue
+            digest = _content_digest(content)
+            diagnostics = _known_diagnostics(session, digest, schema, default_xmlns)
+            if diagnostics is not None:
+                _publish_if_current(
+                    ls, uri, session, version, digest, schema, default_xmlns, diagnostics
+                )
+                continue
+            # Don't wait for the result: the next pending validation, of
+            # another document say, can go to another worker process meanwhile.
+            future = _validation_pool.submit(
+                _validate_in_worker_process, uri, content, schema_path, default_xmlns
+            )
+            future.add_done_callback(
+                partial(
+                    _publish_worker_result,
+                    ls,
+                    uri,
+                    session,
+                    version,
+                    digest,
+                    schema,
+                    default_xmlns,
+                )
+            )
+        except Exception as e:
+            logging.error("Deferred validation of %s failed: %s", uri, e)
 
-    _validate_document(ls, uri, content, schema, default_namespace)
+
+def _publish_if_current(ls, uri, session, version, digest, schema, default_xmlns, diagnostics):
+    """Publishes diagnostics for a version of a document, unless it has been edited since."""
+    with session["lock"]:
+        if session["version"] != version:
+            logging.info("Dropping stale validation results for %s.", uri)
+            return
+        session["validated"] = (digest, schema, default_xmlns, diagnostics)
+    ls.publish_diagnostics(uri, diagnostics)
+
+
+def _publish_worker_result(
+    ls, uri, session, version, digest, schema, default_xmlns, future
+):
+    """Publishes the diagnostics a validation worker process came back with."""
+    try:
+        diagnostics = future.result()
+    except Exception as e:
+        logging.error("Deferred validation of %s failed: %s", uri, e)
+        return
+    _publish_if_current(
+        ls, uri, session, version, digest, schema, default_xmlns, diagnostics
+    )
+
+
+threading.Thread(target=_validation_worker, name="validation", daemon=True).start()
+
+
+def _schedule_validation(
+    ls, uri, schema, schema_path, default_xmlns, version, delay=_VALIDATION_DELAY
+):
+    """Queues a deferred validation of a version of a document."""
+    deadline = time.monotonic() + delay
+    with _pending_validations_cond:
+        heapq.heappush(_validation_deadlines, (deadline, uri))
+        _pending_validations[uri] = (
+            deadline,
+            ls,
+            schema,
+            schema_path,
+            default_xmlns,
+            version,
+        )
+        _pending_validations_cond.notify()
+    logging.info("Scheduled deferred validation for %s.", uri)
+
+
+def _validate_once_loaded(ls, uri):
+    """Returns an on_loaded callback that validates a document straight away."""
+
+    def on_loaded(schema, schema_path, default_xmlns):
+        session = session_cache.get(uri)
+        if not session:
+            return
+        with session["lock"]:
+            version = session["version"]
+        _schedule_validation(
+            ls, uri, schema, schema_path, default_xmlns, version, delay=0
+        )
+
+    return on_loaded
 
 
 @server.feature("textDocument/didChange")
 def did_change(ls, params):
     """Document changed."""
     uri = params.text_document.uri
-    logging.info(f"didChange: {uri}")
+    logging.info("didChange: %s", uri)
 
-    # Ensure session exists, refreshing its TTL
-    if uri not in session_cache or "content" not in session_cache[uri]:
-        logging.info(f"Session or content not found for {uri}, creating/re-reading.")
+    # Ensure session exists
+    if uri not in session_cache or "buf" not in session_cache[uri]:
+        logging.info("Session or content not found for %s, creating/re-reading.", uri)
         
         # Security: Validate the file URI before accessing
         file_path = _validate_file_uri(uri)
         if not file_path:
-            logging.error(f"Invalid or inaccessible file URI: {uri}")
+            logging.error("Invalid or inaccessible file URI: %s", uri)
             return
         
         try:
             with open(file_path, "r", encoding="utf-8") as f:
                 content = f.read()
-                session_cache[uri] = {"content": content}
+                session_cache[uri] = _new_session(content)
         except Exception as e:
-            logging.error(f"Could not read file {uri}: {e}")
+            logging.error("Could not read file %s: %s", uri, e)
             return
 
     session = session_cache[uri]
 
     # figure the current state of the document
-    current_content = session["content"]
-    new_content = _apply_incremental_changes(current_content, params.content_changes)
-    session["content"] = new_content
-
+    with session["lock"]:
+        _apply_incremental_changes(session, params.content_changes)
+        session["version"] += 1
+        version = session["version"]
+        # The tree parsed from the previous version can never be used again;
+        # let it go now rather than holding it through the debounce.
+        session.pop("xml_doc", None)
+
+    # Storing the session again marks it as recently used, and updates its
+    # size now that the content has changed.
+    session_cache[uri] = session
+    _schedule_edit_validation(ls, uri, session, version)
+
+
+def _schedule_edit_validation(ls, uri, session, version):
+    """Schedules validation of a session's content after it was edited."""
     # Schema lookup
-    root_uri = uri.rpartition("/")[0]
     schema = None
+    schema_path = None
     default_namespace = None
-    workspace = ls.workspaces.get(root_uri)
-    if workspace and uri in workspace.schemapaths_for_uri:
-        schema_path = workspace.schemapaths_for_uri[uri]
-        schema = workspace.schemas_for_xsdpath.get(schema_path)
-        if schema_path:
-            default_namespace = workspace.default_xmlns_for_schemapath.get(schema_path)
+    workspace = _workspace_for_uri(ls, uri)
+    if workspace:
+        schema, schema_path, default_namespace = workspace.cached_schema(uri)
+        if schema is None and schema_path:
+            # The schema was evicted from the workspace cache; load it again.
+            schema, schema_path, default_namespace = workspace.get_schema_for_doc(
+                uri, session["buf"], on_loaded=_validate_once_loaded(ls, uri)
+            )
 
     if not schema:
-        return None
-
-    # Immediate validation
-    _validate_document(ls, uri, new_content, schema, default_namespace)
-
-    # As well as deferred validation with a timer, debounced
-    if session.get("timer"):
-        session["timer"].cancel()
-        logging.info(f"Cancelled previous timer for {uri}.")
-
-    def deferred_validation(ls_instance, doc_uri, doc_schema, default_xmlns):
-        logging.info(f"Running deferred validation for {doc_uri}.")
-        if doc_uri in session_cache and "content" in session_cache[doc_uri]:
-            content = session_cache[doc_uri]["content"]
-            _validate_document(ls_instance, doc_uri, content, doc_schema, default_xmlns)
-        else:
-            logging.warning(f"No content found for {doc_uri} in deferred validation.")
+        return
 
-    timer = threading.Timer(
-        4.0, deferred_validation, args=[ls, uri, schema, default_namespace]
-    )
-    session["timer"] = timer
-    timer.start()
-    logging.info(f"Scheduled deferred validation for {uri}.")
+    # Validation is debounced: a burst of keystrokes results in a single
+    # validation, shortly after the typing pauses.
+    _schedule_validation(ls, uri, schema, schema_path, default_namespace, version)
 
 
 @server.feature("textDocument/didSave")
 def did_save(ls, params):
     """Document saved, so refresh content cache."""
     uri = params.text_document.uri
-    logging.info(f"didSave: {uri}, refreshing content cache.")
-    
+    logging.info("didSave: %s, refreshing content cache.", uri)
+
+    session = session_cache.get(uri)
+    if params.text is not None and not (session and "buf" in session):
+        # The client included the saved text. Nothing has looked the schema
+        # up for this session yet, so do that as didOpen would, and validate.
+        session = _new_session(params.text)
+        session_cache[uri] = session
+        workspace = _workspace_for_uri(ls, uri)
+        if not workspace:
+            return
+        schema, schema_path, default_namespace = workspace.get_schema_for_doc(
+            uri, session["buf"], on_loaded=_validate_once_loaded(ls, uri)
+        )
+        if schema:
+            _schedule_validation(
+                ls,
+                uri,
+                schema,
+                schema_path,
+                default_namespace,
+                session["version"],
+                delay=0,
+            )
+        return
+
+    if params.text is not None:
+        # The saved text normally matches the session already. If it doesn't,
+        # it replaces the buffer like a full-document change, so the session
+        # keeps its version sequence and the document is validated again.
+        text = params.text.encode("utf-8")
+        with session["lock"]:
+            changed = session["buf"] != text
+            if changed:
+                session["buf"][:] = text
+                session["line_starts"] = None
+                session["version"] += 1
+                version = session["version"]
+                session.pop("xml_doc", None)
+        session_cache[uri] = session
+        if changed:
+            _schedule_edit_validation(ls, uri, session, version)
+        return
+
+    if session and "buf" in session:
+        # The session already holds what was just saved, since the client
+        # sends every edit with didChange; storing it again marks it as
+        # recently used.
+        session_cache[uri] = session
+        return
+
     # Security: Validate the file URI before accessing
     file_path = _validate_file_uri(uri)
     if not file_path:
-        logging.error(f"Invalid or inaccessible file URI: {uri}")
+        logging.error("Invalid or inaccessible file URI: %s", uri)
         return
     
     try:
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read()
-        session_cache[uri] = {"content": content}
+        session_cache[uri] = _new_session(content)
     except Exception as e:
-        logging.error(f"Could not read file on save for {uri}: {e}")
+        logging.error("Could not read file on save for %s: %s", uri, e)
 
 
 @server.feature("textDocument/didClose")
 def did_close(ls, params):
     """Document closed."""
     uri = params.text_document.uri
-    logging.info(f"didClose: {uri}")
+    logging.info("didClose: %s", uri)
 
-    root_uri = uri.rpartition("/")[0]
-    workspace = ls.workspaces.get(root_uri)
+    workspace = _workspace_for_uri(ls, uri)
+    ls.workspaces_by_uri.pop(uri, None)
+    # The client owns the content of a closed document again; drop the
+    # session now, along with any validation still waiting to run.
+    session_cache.pop(uri, None)
+
+    with _pending_validations_cond:
+        _pending_validations.pop(uri, None)
 
     if workspace:
         workspace.release_document(uri)
     else:
-        logging.warning(f"No workspace found for root URI: {root_uri}")
+        logging.warning("No workspace found for %s", uri)
 
     pass
 
 
-def _local_name_for_element(elt):
-    """Returns the local name of an lxml element, ignoring the namespace."""
-    name = None
-    if hasattr(elt, "tag"):  # for lxml.etree.Element
-        name = elt.tag
-    elif hasattr(elt, "name"):  # for xmlschema
-        name = elt.name
-
-    if name:
-        if "}" in name:
-            return name.split("}", 1)[1]
+_qnames = {}
 
-    return name
 
+def _qname(elt):
+    """
+    Returns the lxml QName for an lxml element or an xmlschema component, or None.
 
-def _namespace_for_element(elt):
-    """Returns the namespace of an lxml element."""
-    name = None
-    if hasattr(elt, "tag"):  # for lxml.etree.Element
-        name = elt.tag
-    elif hasattr(elt, "name"):  # for xmlschema
-        name = elt.name
-
+    QName objects are cached per tag string. There are only as many distinct tags
+    as there are names in the schemas and documents, and they get looked up over
+    and over while building completions.
+    """
+    name = getattr(elt, "tag", None) or getattr(elt, "name", None)
     if not name:
         return None
 
-    if "}" in name:
-        return name.split("}", 1)[0][1:]
+    qname = _qnames.get(name)
+    if qname is None:
+        qname = _qnames[name] = ET.QName(name)
+    return qname
 
-    return ""
+
+def _local_name_for_element(elt):
+    """Returns the local name of an lxml element, ignoring the namespace."""
+    qname = _qname(elt)
+    return qname.localname if qname is not None else None
+
+
+def _namespace_for_element(elt):
+    """Returns the namespace of an lxml element."""
+    qname = _qname(elt)
+    if qname is None:
+        return None
+    return qname.namespace or ""
 
 
 def _get_elements_from_type(xsd_type, default_xmlns, visited_types=None):
@@ -421,9 +926,11 @@ def _get_elements_from_type(xsd_type, default_xmlns, visited_types=None):
     valid_children = []
     if hasattr(xsd_type, "content") and hasattr(xsd_type.content, "iter_elements"):
         for element_node in xsd_type.content.iter_elements():
-            elt_xmlns = _namespace_for_element(element_node)
-            if elt_xmlns == default_xmlns:
-                valid_children.append(_local_name_for_element(element_node))
+            qname = _qname(element_node)
+            if qname is None:
+                continue  # a wildcard, which has no name to offer
+            if (qname.namespace or "") == default_xmlns:
+                valid_children.append(qname.localname)
             else:
                 valid_children.append(element_node.name)
 
@@ -436,110 +943,313 @@ def _get_elements_from_type(xsd_type, default_xmlns, visited_types=None):
     return valid_children
 
 
-def _get_element_context_at_position(
-    schema: xmlschema.XMLSchema, default_namespace: str, xml_content: str, pos: Position
-):
+def _build_completion_index(schema, default_xmlns):
     """
-    Finds the parent element and list of valid child elements at a specific position.
+    Returns a table mapping element local names to their valid child names.
+
+    The table is built in one depth-first pass over the content models,
+    starting from the schema's first root element and then the remaining
+    global elements. When a local name appears more than once, the first
+    element reached wins, which matches the order the completion code used
+    to search in. Child lists are sorted and de-duplicated up front, so a
+    completion request is a single dict lookup. Elements of the same type
+    share one child list, worked out the first time the type comes up.
+    """
+    index = {}
+    children_by_type = {}
+    visited = set()
+    stack = [*reversed(list(schema.elements.values())), schema.root_elements[0]]
+    while stack:
+        xsd_element = stack.pop()
+        if xsd_element in visited:
+            continue
+        visited.add(xsd_element)
+
+        local_name = _local_name_for_element(xsd_element)
+        if local_name not in index:
+            children = children_by_type.get(xsd_element.type)
+            if children is None:
+                children = children_by_type[xsd_element.type] = tuple(
+                    sorted(set(_get_elements_from_type(xsd_element.type, default_xmlns)))
+                )
+            index[local_name] = children
 
-    Args:
-        schema: A loaded xmlschema.XMLSchema object.
-        xml_content: The potentially incomplete XML document as a string.
-        pos: The LSP Position of the cursor.
+        content = getattr(xsd_element.type, "content", None)
+        if hasattr(content, "iter_elements"):
+            stack.extend(reversed(list(content.iter_elements())))
+
+    return index
+
+
+def _completion_index(schema, default_xmlns):
+    """
+    Returns the completion index for a schema, building it on first use.
+
+    Child names are qualified relative to default_xmlns, so the schema keeps
+    one index per default namespace in its _completion_index table.
+    """
+    indexes = schema._completion_index
+    if default_xmlns not in indexes:
+        logging.info("building the completion index for xmlns(%s)", default_xmlns)
+        indexes[default_xmlns] = _build_completion_index(schema, default_xmlns)
+    return indexes[default_xmlns]
+
+
+def _find_enclosing_parent_tag(buf, offset):
+    """
+    Finds the element enclosing a byte offset, by scanning backward from it.
+
+    The scan walks back over the markup preceding the offset, pairing end
+    tags with their start tags, until it reaches a start tag that is still
+    open. The work done is proportional to the markup between that start tag
+    and the cursor, not to the size of the document. A tag the cursor is in
+    the middle of typing is ignored.
 
     Returns:
-        A tuple containing the parent lxml element (or None) and a list of
-        valid child element tag names.
+        The local name of the enclosing element, or "" if the offset is
+        outside the root element. None if the markup could not be made sense
+        of, in which case the caller should fall back to parsing.
+    """
+    end = offset
+    closed = []  # names of the elements closed between here and the cursor
+    while True:
+        lt = buf.rfind(b"<", 0, end)
+        if lt < 0:
+            return "" if not closed else None
+
+        # The "<" may be inside a comment, CDATA section or processing
+        # instruction that ends before the cursor; step back over all of it.
+        opaque_start = None
+        for terminator, opener in _OPAQUE_MARKUP:
+            terminator_pos = buf.rfind(terminator, lt, end)
+            if terminator_pos >= 0:
+                opaque_start = buf.rfind(opener, 0, terminator_pos)
+                break
+        if opaque_start is not None:
+            if opaque_start < 0:
+                return None
+            end = opaque_start
+            continue
+
+        if buf.startswith((b"<!", b"<?"), lt):
+            # A DOCTYPE, or markup the cursor is inside of.
+            end = lt
+            continue
+
+        match = _TAG_RE.match(buf, lt, end)
+        if match is None:
+            if end == offset:
+                # The cursor is inside this tag.
+                end = lt
+                continue
+            return None
+
+        is_end_tag, name, attrs = match.groups()
+        if is_end_tag:
+            closed.append(name)
+        elif attrs.endswith(b"/"):
+            pass  # an empty element
+        elif closed:
+            if closed.pop() != name:
+                return None
+        else:
+            return name.rpartition(b":")[2].decode("utf-8")
+        end = lt
+
+
+def _root_namespace(buf):
+    """Returns the namespace of the root element, read from its start tag."""
+    pos = 0
+    while True:
+        lt = buf.find(b"<", pos)
+        if lt < 0:
+            return None
+        if buf.startswith(b"<!--", lt):
+            pos = buf.find(b"-->", lt)
+        elif buf.startswith(b"<?", lt):
+            pos = buf.find(b"?>", lt)
+        elif buf.startswith(b"<!", lt):
+            # DOCTYPE, or one of the declarations in its internal subset
+            pos = buf.find(b">", lt)
+        else:
+            break
+        if pos < 0:
+            return None
+
+    match = _TAG_RE.match(buf, lt)
+    if match is None:
+        return None
+    prefix = match.group(2).rpartition(b":")[0]
+    for decl in _XMLNS_RE.finditer(match.group(3)):
+        if (decl.group(1) or b"") == prefix:
+            namespace = decl.group(2) if decl.group(2) is not None else decl.group(3)
+            return namespace.decode("utf-8")
+    return None
+
+
+def _recover_parser():
     """
-    logging.info(f"_get_element_context_at_position()")
+    Returns this thread's recovering pull parser, creating it on first use.
 
-    position = _pos_to_offset2(xml_content, pos)
+    The parser reads the buffer as UTF-8 whatever the document declares, and
+    doesn't collect xml:id values, since completion never looks elements up
+    by ID.
+    """
+    parser = getattr(_parsers, "recover", None)
+    if parser is None:
+        parser = _parsers.recover = ET.XMLPullParser(
+            events=("start", "end"),
+            encoding="utf-8",
+            recover=True,
+            collect_ids=False,
+            huge_tree=True,
+        )
+    return parser
+
+
+def _find_parent_by_parsing(buf, offset):
+    """
+    Finds the element enclosing a byte offset, by parsing up to the offset.
 
-    # 1. Insert a temporary marker element at the cursor's position.
-    #    This gives us a node to find in the parsed tree.
-    marker_tag = "completion_marker_fa6fb971-e37d-4316-84ed-27507cf687b8"
-    xml_with_marker = f"{xml_content[:position]}<{marker_tag}/>{xml_content[position:]}"
+    This is the fallback for documents that _find_enclosing_parent_tag cannot
+    make sense of; lxml's recovering parser copes with much more. Only the
+    content before the offset is parsed, and the elements still open when it
+    runs out are the ancestors of the cursor.
 
-    # 2. Parse the potentially broken XML using lxml's recovering parser.
-    parser = ET.XMLParser(recover=True)
+    Returns:
+        A tuple of the local name of the enclosing element (or None), and
+        the namespace of the root element.
+    """
+    parser = _recover_parser()
+    root = None
+    open_elements = []
     try:
-        root = ET.fromstring(xml_with_marker.encode("utf-8"), parser)
+        parser.feed(bytes(buf[:offset]))
+        for event, elt in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = elt
+                open_elements.append(elt)
+            else:
+                open_elements.pop()
     except ET.XMLSyntaxError as e:
-        logging.info(f"could not parse document {e}")
         # The document is too broken to parse even with recovery.
-        return (None, [])
+        logging.info("could not parse document %s", e)
+    finally:
+        # Reset the parser for its next use; the prefix is incomplete by
+        # design, so whatever close() has to say about it doesn't matter.
+        try:
+            parser.close()
+        except ET.XMLSyntaxError:
+            pass
+        for _ in parser.read_events():
+            pass
 
-    default_xmlns = _namespace_for_element(root) or default_namespace
+    if root is None:
+        logging.info("recovering parser found no root element")
+        return (None, None)
 
-    # 3. Find the marker element in the resulting tree.
-    nodeset = root.xpath(f".//*[local-name()='{marker_tag}']")
-    if not nodeset:
-        logging.info(f"xpath returned nothing")
-        return (None, [])
+    root_xmlns = _namespace_for_element(root)
+    if not open_elements:
+        logging.info("the position is outside the root element. Cannot complete.")
+        return (None, root_xmlns)
+
+    return (_local_name_for_element(open_elements[-1]), root_xmlns)
+
+
+def _get_element_context_at_position(
+    schema: xmlschema.XMLSchema,
+    default_namespace: str,
+    buf: bytes,
+    pos: Position,
+    line_starts: array = None,
+):
+    """
+    Finds the parent element and list of valid child elements at a specific position.
 
-    marker = nodeset[0]
-    logging.info(f"retrieved marker {marker}")
+    Args:
+        schema: A loaded xmlschema.XMLSchema object.
+        buf: The potentially incomplete XML document, UTF-8 encoded.
+        pos: The LSP Position of the cursor.
+        line_starts: The line index of buf, if the caller has one.
 
-    # 4. Get the parent of the marker. This is our context.
-    parent = marker.getparent()
-    if parent is None:
-        logging.info(f"the marker element is the root element. Cannot complete.")
+    Returns:
+        A tuple containing the local name of the parent element (or None) and
+        a list of valid child element tag names.
+    """
+    logging.info("_get_element_context_at_position()")
+
+    if line_starts is None:
+        line_starts = _line_starts(buf)
+    offset = _pos_to_byte_offset(buf, line_starts, pos)
+
+    parent_name = _find_enclosing_parent_tag(buf, offset)
+    if parent_name is None:
+        logging.info("could not scan for the parent element, parsing instead")
+        parent_name, root_xmlns = _find_parent_by_parsing(buf, offset)
+    elif parent_name:
+        root_xmlns = _root_namespace(buf)
+    else:
+        logging.info("the position is outside the root element. Cannot complete.")
+        parent_name = None
+
+    if not parent_name:
         return (None, [])
 
-    # 5. Find the schema definition for the parent element.
-    def _get_child_by_name_recurse(schema_elt, childtag, visited=None):
-        if _local_name_for_element(schema_elt) == childtag:
-            return schema_elt
-
-        if visited is None:
-            visited = set()
-
-        foundchild = None
-        if hasattr(schema_elt.type, "content"):
-            if hasattr(schema_elt.type.content, "iter_elements"):
-                for x in schema_elt.type.content.iter_elements():
-                    if x not in visited:
-                        if not foundchild:
-                            logging.info(
-                                f"checking x.name({x.name}) vs child({childtag})"
-                            )
-                            if _local_name_for_element(x) == childtag:
-                                foundchild = x
-                            else:
-                                visited.add(x)
-                                foundchild = _get_child_by_name_recurse(
-                                    x, childtag, visited
-                                )
-        return foundchild
+    default_xmlns = root_xmlns or default_namespace
 
-    try:
-        logging.info(f"looking for parent element {parent.tag}")
-        parent_xsd_element = _get_child_by_name_recurse(
-            schema.root_elements[0], _local_name_for_element(parent)
-        )
-        if parent_xsd_element is None:
-            logging.info(f"no parent element found in the schema")
-            return (parent, [])
-    except KeyError:
-        logging.info(f"KeyError while finding parent element in the schema")
-        return (parent, [])  # Parent tag not found in schema.
-
-    # 6. Extract the list of all possible child elements from the schema definition.
-    #    The .type.content object is an XsdGroup that contains the content model.
-    #    We can iterate over it to get all possible child elements.
+    # 5. Look up the valid children for the parent element. The index is
+    #    built from the content models of the schema. Each .type.content
+    #    object is an XsdGroup that contains the content model of an element.
     #
     # NB: The MSBuild xsd defines the Property type as "abstract" so I guess it
     # can literally be anything. So completions within a PropertyGroup...
     # are not helpful.
-
-    logging.info(f"found parent element in the schema {parent_xsd_element}")
-    valid_children = _get_elements_from_type(parent_xsd_element.type, default_xmlns)
+    logging.info("looking for parent element %s", parent_name)
+    valid_children = _completion_index(schema, default_xmlns).get(parent_name)
+    if valid_children is None:
+        logging.info("no parent element found in the schema")
+        return (parent_name, [])
 
     # TODO: Filter out elements that already exist if the schema says they
     # cannot appear more than once.  For now, we return all possibilities, and
     # let later validation sort that out.
 
-    return (parent, sorted(list(set(valid_children))))
+    return (parent_name, list(valid_children))
+
+
+# The CompletionItems built for each (parent, valid children) pair.
+_completion_items_cache = LRUCache(maxsize=256)
+
+
+def _completion_items(parent_name, completions):
+    """
+    Returns the completion items for the valid children of an element.
+
+    Consecutive completion requests within the same element get the same
+    items back, so they are built once and kept in _completion_items_cache.
+    The caller must not modify the returned list.
+    """
+    key = (parent_name, tuple(completions))
+    items = _completion_items_cache.get(key)
+    if items is None:
+        items = [
+            CompletionItem(
+                label=label, kind=CompletionItemKind.Struct, insert_text=f"<{label}>"
+            )
+            for label in completions
+        ]
+
+        if parent_name is not None:
+            items.append(
+                CompletionItem(
+                    label=f"close {parent_name}",
+                    kind=CompletionItemKind.Struct,
+                    insert_text=f"</{parent_name}>",
+                )
+            )
+        _completion_items_cache[key] = items
+    return items
 
 
 @server.feature("textDocument/completion")
@@ -547,57 +1257,37 @@ def completion(ls, params):
     """Provide completion suggestions."""
     uri = params.text_document.uri
     pos = params.position
-    logging.info(f"completion for {uri} at {pos.line}:{pos.character}")
+    logging.info("completion for %s at %s:%s", uri, pos.line, pos.character)
 
-    if uri not in session_cache or "content" not in session_cache[uri]:
-        logging.info(f"no session or no content")
+    if uri not in session_cache or "buf" not in session_cache[uri]:
+        logging.info("no session or no content")
         return CompletionList(is_incomplete=False, items=[])
 
-    content = session_cache[uri]["content"]
+    session = session_cache[uri]
 
-    root_uri = uri.rpartition("/")[0]
-    logging.info(f"getting workspace for {root_uri}")
-    workspace = ls.workspaces.get(root_uri)
+    workspace = _workspace_for_uri(ls, uri)
     if not workspace:
-        logging.info(f"no workspace for {uri}")
+        logging.info("no workspace for %s", uri)
         return CompletionList(is_incomplete=False, items=[])
 
-    schema, schema_path = workspace.get_schema_for_doc(uri, content)
+    schema, _, default_namespace = workspace.get_schema_for_doc(uri, session["buf"])
 
     if not schema:
-        logging.info(f"no schema")
+        logging.info("no schema")
         return CompletionList(is_incomplete=False, items=[])
 
-    logging.info(f"got schema {schema}")
-    logging.info(f"schema-defined elements: {list(schema.elements.keys())}")
+    logging.info("got schema %s", schema)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("schema-defined elements: %s", list(schema.elements.keys()))
 
-    default_namespace = None
-    if schema_path:
-        default_namespace = workspace.default_xmlns_for_schemapath.get(schema_path)
-
-    parent_element, completions = _get_element_context_at_position(
-        schema, default_namespace, content, pos
+    parent_name, completions = _get_element_context_at_position(
+        schema, default_namespace, session["buf"], pos, _session_line_starts(session)
     )
-    logging.info(f"Found {len(completions)} completions: {completions}")
-
-    items = [
-        CompletionItem(
-            label=label, kind=CompletionItemKind.Struct, insert_text=f"<{label}>"
-        )
-        for label in completions
-    ]
-
-    if parent_element is not None:
-        local_name = _local_name_for_element(parent_element)
-        items.append(
-            CompletionItem(
-                label=f"close {local_name}",
-                kind=CompletionItemKind.Struct,
-                insert_text=f"</{local_name}>",
-            )
-        )
+    logging.info("Found %s completions: %s", len(completions), completions)
 
-    return CompletionList(is_incomplete=False, items=items)
+    return CompletionList(
+        is_incomplete=False, items=_completion_items(parent_name, completions)
+    )
 
 
 def main():
@@ -621,6 +1311,17 @@ def main():
             "--log-file is not specified."
         ),
     )
+    parser.add_argument(
+        "--validation-processes",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Validate edited documents in N worker processes, so that long "
+            "validations do not hold up completion. By default validation "
+            "runs in the server process."
+        ),
+    )
     args = parser.parse_args()
 
     log_file = args.log_file
@@ -650,6 +1351,14 @@ def main():
         # Set the logging level for pygls to avoid overly verbose output.
         logging.getLogger("pygls").setLevel(log_level)
 
+    if args.validation_processes > 0:
+        global _validation_pool
+        # spawn rather than fork: the server process already has threads.
+        _validation_pool = ProcessPoolExecutor(
+            max_workers=args.validation_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
     logging.info("Starting XML language server.")
     server.start_io()
 